@@ -2,7 +2,15 @@ import streamlit as st
 import requests
 from neo4j import GraphDatabase
 import uuid
+import json
+import gzip
+import hashlib
+import io
+from concurrent.futures import ThreadPoolExecutor
 from streamlit_agraph import agraph, Node, Edge, Config
+from rollups import (UNSYNCED_LINKS, empty_rollup, add_rollup, node_rollup, rollup_to_props, rollup_from_props,
+                     refresh_rollups)
+from tb_relations import extract_relations
 
 import os
 from dotenv import load_dotenv
@@ -16,6 +24,23 @@ NEO4J_URI = os.getenv("NEO4J_URI")
 NEO4J_USER = os.getenv("NEO4J_USER")
 NEO4J_PASS = os.getenv("NEO4J_PASSWORD")
 
+DELETE_BATCH_SIZE = 500
+CLOUD_WORKERS = 8
+SNAPSHOT_VERSION = 1
+SNAPSHOT_BATCH_SIZE = 1000
+LINK_BATCH_SIZE = 1000
+RELATION_MAX_LEVEL = int(os.getenv("RELATION_MAX_LEVEL", "0"))
+
+
+def entity_hash(item):
+    """Fingerprint of a ThingsBoard entity, used to skip unchanged ones on delta sync"""
+    return hashlib.sha1(json.dumps(item, sort_keys=True).encode()).hexdigest()
+
+
+def entity_label(entity_type):
+    return "Device" if entity_type == "DEVICE" else "Asset"
+
+
 @st.cache_resource
 def get_driver():
     driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASS))
@@ -37,7 +62,10 @@ class IoTManager:
         with self.driver.session() as session:
             query = """
             MATCH (n:Asset) 
-            RETURN n.name AS Name, n.type AS Type, n.status AS Status, n.id AS ID
+            RETURN n.name AS Name, n.type AS Type, n.status AS Status, n.id AS ID,
+                   n.rollup_devices AS Devices, n.rollup_devices_draft AS DraftDevices,
+                   n.rollup_device_types AS DeviceTypes, n.rollup_drafts AS Drafts,
+                   n.rollup_unsynced_links AS UnsyncedLinks
             ORDER BY n.status DESC, n.name ASC
             """
             return [record.data() for record in session.run(query)]
@@ -104,12 +132,146 @@ class IoTManager:
 
         return nodes, edges
 
+    def rebuild_rollups(self):
+        """Recompute the rollups of every Asset in one pass over the Contains tree"""
+        return f"✅ Rollups rebuilt for {refresh_rollups(self.driver)} Assets"
+
+    def _subtree_rollup(self, tx, node_id):
+        """Counters a node and everything it contains add to the Assets above it"""
+        r = tx.run(f"""
+            MATCH (n {{id: $id}})
+            OPTIONAL MATCH (n)-[rel]->(m) WHERE {UNSYNCED_LINKS}
+            RETURN labels(n) AS labels, n.type AS type, n.status AS status,
+                   properties(n) AS props, count(rel) AS unsynced
+        """, id=node_id).single()
+        if not r:
+            return empty_rollup()
+
+        total = node_rollup(r['labels'], r['type'], r['status'])
+        if "Asset" in r['labels']:
+            return add_rollup(total, rollup_from_props(r['props']))
+
+        # Devices keep no rollup of their own, so count whatever they contain like refresh_rollups does
+        total["unsynced_links"] += r['unsynced']
+        descendants = tx.run(f"""
+            MATCH (n {{id: $id}})-[:Contains*1..]->(m) WHERE m <> n AND (m:Asset OR m:Device)
+            WITH DISTINCT m AS d
+            OPTIONAL MATCH (d)-[rel]->(m) WHERE {UNSYNCED_LINKS}
+            RETURN labels(d) AS labels, d.type AS type, d.status AS status, count(rel) AS unsynced
+        """, id=node_id)
+        for d in descendants:
+            add_rollup(total, node_rollup(d['labels'], d['type'], d['status']))
+            total["unsynced_links"] += d['unsynced']
+        return total
+
+    def _shared_subtree(self, tx, node_id):
+        """
+        True when something under the node is reachable by a second Contains path or loops back to it.
+        Deltas would count it once per path there, so callers rebuild with refresh_rollups instead.
+        """
+        return tx.run("""
+            MATCH (n {id: $id})-[:Contains*0..]->(d)
+            WITH n, collect(DISTINCT d) AS subtree
+            RETURN any(d IN subtree WHERE size([(p)-[:Contains]->(d) | p]) > 1 OR (d)-[:Contains]->(n)) AS shared
+        """, id=node_id).single()['shared']
+
+    def _shift_rollups(self, tx, node_id, delta, include_self=False, sign=1):
+        """Apply a delta to the rollups of every Asset containing the node (and the node itself if asked)"""
+        # A node is never its own descendant, even inside a Contains cycle
+        min_depth, not_self = (0, "") if include_self else (1, "WHERE a <> n ")
+        ancestors = tx.run(
+            f"MATCH (a:Asset)-[:Contains*{min_depth}..]->(n {{id: $id}}) {not_self}"
+            "RETURN DISTINCT a.id AS id, properties(a) AS props",
+            id=node_id
+        )
+        rows = [{"id": r['id'], "props": rollup_to_props(add_rollup(rollup_from_props(r['props']), delta, sign))}
+                for r in ancestors]
+        if rows:
+            tx.run("UNWIND $rows AS row MATCH (a:Asset {id: row.id}) SET a += row.props", rows=rows)
+
+    def _mark_node_synced(self, tx, label, old_id, new_id):
+        r = tx.run(
+            f"MATCH (n:{label} {{id: $old_id}}) WITH n, n.status AS old_status "
+            "SET n.id = $new_id, n.status = 'synced' "
+            "RETURN labels(n) AS labels, n.type AS type, old_status",
+            old_id=old_id, new_id=new_id
+        ).single()
+        if r:
+            delta = add_rollup(node_rollup(r['labels'], r['type'], 'synced'),
+                               node_rollup(r['labels'], r['type'], r['old_status']), -1)
+            self._shift_rollups(tx, new_id, delta)
+
+    def _create_relation_tx(self, tx, from_name, to_name, rel_type):
+        created = tx.run(f"""
+            MATCH (a), (b) 
+            WHERE a.name = $from_name AND b.name = $to_name
+            OPTIONAL MATCH (a)-[existing:{rel_type}]->(b)
+            WITH a, b, existing
+            MERGE (a)-[:{rel_type}]->(b)
+            RETURN a.id AS from_id, b.id AS to_id, existing IS NULL AS created
+        """, from_name=from_name, to_name=to_name).data()
+
+        for r in created:
+            if not r['created']:
+                continue
+            if rel_type == "Contains":
+                if self._shared_subtree(tx, r['to_id']):
+                    return True
+                self._shift_rollups(tx, r['from_id'], self._subtree_rollup(tx, r['to_id']), include_self=True)
+            self._shift_rollups(tx, r['from_id'], {"unsynced_links": 1}, include_self=True)
+        return False
+
+    def _delete_relation_tx(self, tx, from_name, to_name, rel_type):
+        links = tx.run(
+            f"MATCH (a {{name: $f}})-[r:{rel_type}]->(b {{name: $t}}) "
+            "RETURN a.id AS from_id, b.id AS to_id, r.status AS status",
+            f=from_name, t=to_name
+        ).data()
+
+        shared = rel_type == "Contains" and any(self._shared_subtree(tx, r['to_id']) for r in links)
+        for r in links:
+            if shared:
+                break
+            if rel_type == "Contains":
+                self._shift_rollups(tx, r['from_id'], self._subtree_rollup(tx, r['to_id']), include_self=True, sign=-1)
+            if r['status'] != 'synced':
+                self._shift_rollups(tx, r['from_id'], {"unsynced_links": 1}, include_self=True, sign=-1)
+
+        tx.run(f"MATCH (a {{name: $f}})-[r:{rel_type}]->(b {{name: $t}}) DELETE r", f=from_name, t=to_name)
+        return shared
+
+    def _mark_relation_synced(self, tx, from_name, to_name, rel_type):
+        links = tx.run(
+            f"MATCH (a {{name: $f}})-[r:{rel_type}]->(b {{name: $t}}) WITH a, r, r.status AS old_status "
+            "SET r.status = 'synced' RETURN a.id AS from_id, old_status",
+            f=from_name, t=to_name
+        ).data()
+        for r in links:
+            if r['old_status'] != 'synced':
+                self._shift_rollups(tx, r['from_id'], {"unsynced_links": 1}, include_self=True, sign=-1)
+
+    def _delete_node_tx(self, tx, node_id):
+        shared = self._shared_subtree(tx, node_id)
+        if not shared:
+            self._shift_rollups(tx, node_id, self._subtree_rollup(tx, node_id), sign=-1)
+
+            incoming = tx.run("""
+                MATCH (src)-[rel]->(n {id: $id})
+                WHERE (src:Asset OR src:Device) AND src <> n AND coalesce(rel.status, '') <> 'synced'
+                RETURN src.id AS id, count(rel) AS unsynced
+            """, id=node_id)
+            for r in list(incoming):
+                self._shift_rollups(tx, r['id'], {"unsynced_links": r['unsynced']}, include_self=True, sign=-1)
+
+        tx.run("MATCH (n) WHERE n.id = $id DETACH DELETE n", id=node_id)
+        return shared
+
     def create_draft_asset(self, name, asset_type):
         temp_id = str(uuid.uuid4())
         with self.driver.session() as session:
             session.run(
-                "CREATE (a:Asset {id: $id, name: $name, type: $type, status: 'draft'})",
-                id=temp_id, name=name, type=asset_type
+                "CREATE (a:Asset {id: $id, name: $name, type: $type, status: 'draft'}) SET a += $rollup",
+                id=temp_id, name=name, type=asset_type, rollup=rollup_to_props(empty_rollup())
             )
 
     def create_draft_device(self, name, device_type, label=None):
@@ -122,12 +284,8 @@ class IoTManager:
 
     def create_relation(self, from_name, to_name, rel_type):
         with self.driver.session() as session:
-            query = f"""
-            MATCH (a), (b) 
-            WHERE a.name = $from_name AND b.name = $to_name
-            MERGE (a)-[:{rel_type}]->(b)
-            """
-            session.run(query, from_name=from_name, to_name=to_name)
+            if session.execute_write(self._create_relation_tx, from_name, to_name, rel_type):
+                refresh_rollups(self.driver)
 
     def sync_assets_to_cloud(self):
             token = self.get_token()
@@ -159,11 +317,7 @@ class IoTManager:
                         real_id = res.json()['id']['id']
 
                         with self.driver.session() as session:
-                            session.run(
-                                "MATCH (n:Asset {id: $old_id}) SET n.id = $new_id, n.status = 'synced'",
-                                old_id=node['id'],
-                                new_id=real_id
-                            )
+                            session.execute_write(self._mark_node_synced, "Asset", node['id'], real_id)
                         success_count += 1
                     else:
                         errors.append(f"Failed '{node['name']}': HTTP {res.status_code} - {res.text}")
@@ -207,11 +361,7 @@ class IoTManager:
                     real_id = res.json()['id']['id']
 
                     with self.driver.session() as session:
-                        session.run(
-                            "MATCH (n:Device {id: $old_id}) SET n.id = $new_id, n.status = 'synced'",
-                            old_id=node['id'],
-                            new_id=real_id
-                        )
+                        session.execute_write(self._mark_node_synced, "Device", node['id'], real_id)
                     success_count += 1
                 else:
                     errors.append(f"Failed '{node['name']}': {res.status_code}")
@@ -254,8 +404,7 @@ class IoTManager:
             res = requests.post(f"{TB_URL}/api/relation", json=payload, headers=headers)
             if res.status_code == 200:
                 with self.driver.session() as session:
-                    session.run(f"MATCH (a {{name: $f}})-[r:{rel_type}]->(b {{name: $t}}) SET r.status = 'synced'",
-                                f=from_name, t=to_name)
+                    session.execute_write(self._mark_relation_synced, from_name, to_name, rel_type)
                 return f"✅ Linked: {from_name} -> {to_name}"
             else:
                 return f"⚠️ Error {res.status_code}"
@@ -266,6 +415,7 @@ class IoTManager:
         token = self.get_token()
         if not token: return "❌ Auth Failed"
         headers = {"X-Authorization": f"Bearer {token}"}
+        self.ensure_indexes()
 
         asset_ids = []
         device_ids = []
@@ -277,8 +427,8 @@ class IoTManager:
                 assets = res.json()['data']
                 with self.driver.session() as session:
                     for item in assets:
-                        query = "MERGE (n:Asset {id: $id}) SET n.name = $name, n.type = $type, n.status = 'synced'"
-                        session.run(query, id=item['id']['id'], name=item['name'], type=item['type'])
+                        query = "MERGE (n:Asset {id: $id}) SET n.name = $name, n.type = $type, n.status = 'synced', n.sync_hash = $hash"
+                        session.run(query, id=item['id']['id'], name=item['name'], type=item['type'], hash=entity_hash(item))
                         asset_ids.append(item['id']['id'])
                 messages.append(f"✅ {len(assets)} Assets")
         except Exception as e:
@@ -291,40 +441,234 @@ class IoTManager:
                 with self.driver.session() as session:
                     for item in devices:
                         lbl = item.get('label', 'Device')
-                        query = "MERGE (n:Device {id: $id}) SET n.name = $name, n.type = $type, n.label = $lbl, n.status = 'synced'"
-                        session.run(query, id=item['id']['id'], name=item['name'], type=item['type'], lbl=lbl)
+                        query = "MERGE (n:Device {id: $id}) SET n.name = $name, n.type = $type, n.label = $lbl, n.status = 'synced', n.sync_hash = $hash"
+                        session.run(query, id=item['id']['id'], name=item['name'], type=item['type'], lbl=lbl, hash=entity_hash(item))
                         device_ids.append(item['id']['id'])
                 messages.append(f"✅ {len(devices)} Devices")
         except Exception as e:
             messages.append(f"❌ Devices: {str(e)}")
 
-        rel_count = 0
         all_ids = [(uid, 'ASSET') for uid in asset_ids] + [(uid, 'DEVICE') for uid in device_ids]
 
+        try:
+            with self.driver.session() as session:
+                links = extract_relations(TB_URL, headers, all_ids, self._known_children(session),
+                                          max_level=RELATION_MAX_LEVEL)
+                self._merge_links(session, links)
+            messages.append(f"✅ {len(links)} Relations")
+        except Exception as e:
+            messages.append(f"❌ Relations: {str(e)}")
+
+        messages.append(self.rebuild_rollups())
+        return " | ".join(messages)
+
+    def _known_children(self, session):
+        """IDs that already have a parent in the graph, so traversals start from their roots first"""
+        return {r['id'] for r in session.run(
+            "MATCH (a)-->(n) WHERE (a:Asset OR a:Device) AND (n:Asset OR n:Device) RETURN DISTINCT n.id AS id")}
+
+    def _group_links(self, links):
+        """Group ThingsBoard relations by (from label, type, to label) so every batch can match on the id indexes"""
+        groups = {}
+        for r in links:
+            key = (entity_label(r['from']['entityType']), r['type'], entity_label(r['to']['entityType']))
+            groups.setdefault(key, []).append({"from_id": r['from']['id'], "to_id": r['to']['id']})
+        return groups
+
+    def _merge_links(self, session, links):
+        for (from_label, rel_type, to_label), rows in self._group_links(links).items():
+            rel_type = rel_type.replace("`", "``")
+            for i in range(0, len(rows), LINK_BATCH_SIZE):
+                session.run(f"UNWIND $rows AS row "
+                            f"MATCH (a:{from_label} {{id: row.from_id}}), (b:{to_label} {{id: row.to_id}}) "
+                            f"MERGE (a)-[r:`{rel_type}`]->(b) SET r.status = 'synced'",
+                            rows=rows[i:i + LINK_BATCH_SIZE])
+
+    def _delete_links(self, session, links):
+        for (from_label, rel_type, to_label), rows in self._group_links(links).items():
+            rel_type = rel_type.replace("`", "``")
+            for i in range(0, len(rows), LINK_BATCH_SIZE):
+                session.run(f"UNWIND $rows AS row "
+                            f"MATCH (a:{from_label} {{id: row.from_id}})-[r:`{rel_type}`]->(b:{to_label} {{id: row.to_id}}) "
+                            f"DELETE r",
+                            rows=rows[i:i + LINK_BATCH_SIZE])
+
+    def _fetch_entities(self, headers, kind):
+        """All tenant assets or devices, following ThingsBoard pagination"""
+        items = []
+        page = 0
+        while True:
+            res = requests.get(f"{TB_URL}/api/tenant/{kind}s?pageSize=1000&page={page}", headers=headers)
+            res.raise_for_status()
+            body = res.json()
+            items.extend(body['data'])
+            if not body.get('hasNext'):
+                return items
+            page += 1
+
+    def ensure_indexes(self):
+        with self.driver.session() as session:
+            session.run("CREATE INDEX asset_id IF NOT EXISTS FOR (n:Asset) ON (n.id)")
+            session.run("CREATE INDEX device_id IF NOT EXISTS FOR (n:Device) ON (n.id)")
+
+    def export_snapshot(self, fileobj):
+        """Stream every node and relation into fileobj as gzipped JSONL"""
+        nodes = 0
+        relations = 0
+        with gzip.open(fileobj, "wt", encoding="utf-8") as out, self.driver.session() as session:
+            out.write(json.dumps({"kind": "meta", "version": SNAPSHOT_VERSION}) + "\n")
+
+            result = session.run("""
+                MATCH (n) WHERE n:Asset OR n:Device
+                RETURN CASE WHEN n:Device THEN 'Device' ELSE 'Asset' END AS label, properties(n) AS props
+            """)
+            for r in result:
+                out.write(json.dumps({"kind": "node", "label": r['label'], "props": r['props']}, default=str) + "\n")
+                nodes += 1
+
+            result = session.run("""
+                MATCH (a)-[r]->(b) WHERE (a:Asset OR a:Device) AND (b:Asset OR b:Device)
+                RETURN CASE WHEN a:Device THEN 'Device' ELSE 'Asset' END AS from_label, a.id AS from_id,
+                       CASE WHEN b:Device THEN 'Device' ELSE 'Asset' END AS to_label, b.id AS to_id,
+                       type(r) AS type, properties(r) AS props
+            """)
+            for r in result:
+                out.write(json.dumps({"kind": "rel", **r.data()}, default=str) + "\n")
+                relations += 1
+
+        return f"✅ Exported {nodes} Nodes and {relations} Relations"
+
+    def restore_snapshot(self, fileobj):
+        """Bulk load a snapshot written by export_snapshot, in batched UNWIND transactions"""
+        self.ensure_indexes()
+        nodes = 0
+        relations = 0
+        batches = {}
+
+        def flush(key, session):
+            rows = batches.pop(key, [])
+            if not rows:
+                return
+            if key[0] == "node":
+                query = f"UNWIND $rows AS row MERGE (n:{key[1]} {{id: row.id}}) SET n += row.props"
+            else:
+                rel_type = key[2].replace("`", "``")
+                query = (f"UNWIND $rows AS row MATCH (a:{key[1]} {{id: row.from_id}}), (b:{key[3]} {{id: row.to_id}}) "
+                         f"MERGE (a)-[r:`{rel_type}`]->(b) SET r += row.props")
+            session.run(query, rows=rows)
+
+        with gzip.open(fileobj, "rt", encoding="utf-8") as src, self.driver.session() as session:
+            meta = json.loads(src.readline() or "{}")
+            if meta.get("kind") != "meta" or meta.get("version") != SNAPSHOT_VERSION:
+                return "❌ Unsupported snapshot file."
+
+            for line in src:
+                record = json.loads(line)
+                if record['kind'] == "node":
+                    if record['label'] not in ("Asset", "Device"):
+                        continue
+                    key = ("node", record['label'])
+                    batches.setdefault(key, []).append({"id": record['props']['id'], "props": record['props']})
+                    nodes += 1
+                else:
+                    if record['from_label'] not in ("Asset", "Device") or record['to_label'] not in ("Asset", "Device"):
+                        continue
+                    # Nodes are written first, so they must all be in the graph before any relation is matched
+                    for node_key in [k for k in batches if k[0] == "node"]:
+                        flush(node_key, session)
+                    key = ("rel", record['from_label'], record['type'], record['to_label'])
+                    batches.setdefault(key, []).append(
+                        {"from_id": record['from_id'], "to_id": record['to_id'], "props": record['props']})
+                    relations += 1
+                if len(batches[key]) >= SNAPSHOT_BATCH_SIZE:
+                    flush(key, session)
+
+            for key in sorted(batches, key=lambda k: k[0] != "node"):
+                flush(key, session)
+
+        return f"✅ Restored {nodes} Nodes and {relations} Relations"
+
+    def delta_sync_from_cloud(self):
+        """
+        Bring a restored graph up to date: rewrite only entities whose ThingsBoard payload changed,
+        then reconcile every relation against one hierarchy traversal pass.
+        """
+        token = self.get_token()
+        if not token: return "❌ Auth Failed"
+        headers = {"X-Authorization": f"Bearer {token}"}
+
+        with self.driver.session() as session:
+            known = {r['id']: (r['hash'], r['label']) for r in session.run(
+                "MATCH (n) WHERE (n:Asset OR n:Device) AND coalesce(n.status, 'synced') = 'synced' "
+                "RETURN n.id AS id, n.sync_hash AS hash, CASE WHEN n:Asset THEN 'Asset' ELSE 'Device' END AS label")}
+
+        seen = {}
+        changed = 0
         with self.driver.session() as session:
-            for entity_id, entity_type in all_ids:
+            for kind, label in (("asset", "Asset"), ("device", "Device")):
                 try:
-                    r_res = requests.get(f"{TB_URL}/api/relations/info?fromId={entity_id}&fromType={entity_type}",
-                                         headers=headers)
-                    if r_res.status_code == 200:
-                        relations = r_res.json()
-                        for rel in relations:
-                            target_id = rel['to']['id']
-                            rel_type = rel['type']
-
-                            query = f"""
-                            MATCH (a {{id: $src}}), (b {{id: $tgt}})
-                            MERGE (a)-[r:{rel_type}]->(b)
-                            SET r.status = 'synced'
-                            """
-                            session.run(query, src=entity_id, tgt=target_id)
-                            rel_count += 1
-                except:
-                    pass
-
-        messages.append(f"✅ {rel_count} Relations")
+                    items = self._fetch_entities(headers, kind)
+                except Exception as e:
+                    # Without the full list we cannot tell what was deleted, so stop here
+                    return f"❌ {label}s: {str(e)}"
+
+                rows = []
+                for item in items:
+                    uid = item['id']['id']
+                    seen[uid] = kind.upper()
+                    item_hash = entity_hash(item)
+                    if known.get(uid, (None,))[0] != item_hash:
+                        rows.append({"id": uid, "name": item['name'], "type": item['type'],
+                                     "label": item.get('label', 'Device'), "hash": item_hash})
+                changed += len(rows)
+
+                label_set = ", n.label = row.label" if label == "Device" else ""
+                for i in range(0, len(rows), SNAPSHOT_BATCH_SIZE):
+                    session.run(f"UNWIND $rows AS row MERGE (n:{label} {{id: row.id}}) "
+                                f"SET n.name = row.name, n.type = row.type{label_set}, "
+                                "n.status = 'synced', n.sync_hash = row.hash",
+                                rows=rows[i:i + SNAPSHOT_BATCH_SIZE])
+
+            stale = [uid for uid in known if uid not in seen]
+            for label in ("Asset", "Device"):
+                ids = [uid for uid in stale if known[uid][1] == label]
+                for i in range(0, len(ids), DELETE_BATCH_SIZE):
+                    session.run(f"UNWIND $ids AS id MATCH (n:{label} {{id: id}}) DETACH DELETE n",
+                                ids=ids[i:i + DELETE_BATCH_SIZE])
+
+            # Links can change without touching either entity's payload, so every relation is checked
+            failed = set()
+            cloud_links = {(r['from']['id'], r['to']['id'], r['type']): r
+                           for r in extract_relations(TB_URL, headers, list(seen.items()), self._known_children(session),
+                                                      max_level=RELATION_MAX_LEVEL, failed=failed)}
+            # Local links in the same shape as ThingsBoard's, so both sides group by label the same way
+            local_links = {(r['from_id'], r['to_id'], r['type']): {
+                "from": {"id": r['from_id'], "entityType": r['from_type']},
+                "to": {"id": r['to_id'], "entityType": r['to_type']}, "type": r['type']
+            } for r in session.run("""
+                MATCH (a)-[r]->(b)
+                WHERE (a:Asset OR a:Device) AND (b:Asset OR b:Device) AND r.status = 'synced'
+                RETURN a.id AS from_id, b.id AS to_id, type(r) AS type,
+                       CASE WHEN a:Asset THEN 'ASSET' ELSE 'DEVICE' END AS from_type,
+                       CASE WHEN b:Asset THEN 'ASSET' ELSE 'DEVICE' END AS to_type
+            """)}
+
+            removed = [r for key, r in local_links.items() if key not in cloud_links and key[0] not in failed]
+            added = [r for key, r in cloud_links.items() if key not in local_links]
+            self._delete_links(session, removed)
+            self._merge_links(session, added)
+
+        messages = [f"✅ {changed} Changed", f"🗑️ {len(stale)} Removed",
+                    f"🔗 +{len(added)} / -{len(removed)} Relations", self.rebuild_rollups()]
         return " | ".join(messages)
 
+    def warm_start(self, fileobj):
+        """Restore a snapshot, then catch up with ThingsBoard through a delta sync"""
+        msg = self.restore_snapshot(fileobj)
+        if "❌" in msg:
+            return msg
+        return msg + " | " + self.delta_sync_from_cloud()
+
     def delete_node(self, node_id, node_label, policy):
         msg = ""
         if policy == "strict":
@@ -339,10 +683,130 @@ class IoTManager:
                     msg += f"⚠️ Cloud Fail ({res.status_code}). "
 
         with self.driver.session() as session:
-            session.run("MATCH (n) WHERE n.id = $id DETACH DELETE n", id=node_id)
+            if session.execute_write(self._delete_node_tx, node_id):
+                refresh_rollups(self.driver)
             msg += "Graph Node Deleted."
         return msg
 
+    def preview_cascade_delete(self, node_id):
+        """Dry run: collect a node and its Contains subtree, deepest entities first"""
+        with self.driver.session() as session:
+            rows = session.run("""
+                MATCH path = (root {id: $id})-[:Contains*0..]->(n)
+                WITH n, max(length(path)) AS depth
+                OPTIONAL MATCH (n)-[r]-(other) WHERE other:Asset OR other:Device
+                RETURN n.id AS id, n.name AS name, labels(n) AS labels, n.status AS status, depth,
+                       collect(CASE WHEN r IS NULL THEN NULL ELSE {
+                           from_id: startNode(r).id, from_name: startNode(r).name, from_labels: labels(startNode(r)),
+                           to_id: endNode(r).id, to_name: endNode(r).name, to_labels: labels(endNode(r)),
+                           type: type(r), status: r.status
+                       } END) AS links
+                ORDER BY depth DESC
+            """, id=node_id).data()
+
+        nodes = []
+        relations = {}
+        for r in rows:
+            for link in r.pop('links'):
+                relations[(link['from_id'], link['to_id'], link['type'])] = link
+            nodes.append(r)
+
+        ids = {n['id'] for n in nodes}
+        for n in nodes:
+            n['parents'] = [key[0] for key in relations
+                            if key[2] == "Contains" and key[1] == n['id'] and key[0] in ids and key[0] != n['id']]
+        return {"nodes": nodes, "relations": list(relations.values())}
+
+    def _cloud_delete(self, url, headers, params=None):
+        try:
+            res = requests.delete(url, params=params, headers=headers)
+            # 404 means ThingsBoard no longer has it, which is what we wanted
+            return None if res.status_code in (200, 404) else f"HTTP {res.status_code}"
+        except Exception as e:
+            return str(e)
+
+    def _detach_subtree_tx(self, tx, deleted, plan):
+        """Take the deleted entities out of the rollups of whatever survives around them"""
+        root = next(n['id'] for n in plan['nodes'] if n['depth'] == 0)
+        if self._shared_subtree(tx, root):
+            return True
+        for n in plan['nodes']:
+            if n['id'] in deleted and not any(p in deleted for p in n['parents']):
+                self._shift_rollups(tx, n['id'], self._subtree_rollup(tx, n['id']), sign=-1)
+        for link in plan['relations']:
+            if link['to_id'] in deleted and link['from_id'] not in deleted and link['status'] != 'synced':
+                self._shift_rollups(tx, link['from_id'], {"unsynced_links": 1}, include_self=True, sign=-1)
+        return False
+
+    def cascade_delete(self, node_id, policy):
+        """Delete a node and its whole Contains subtree, leaves first"""
+        plan = self.preview_cascade_delete(node_id)
+        if not plan['nodes']: return "❌ Node not found."
+
+        errors = []
+        rel_count = 0
+        deleted = set()
+
+        if policy == "strict":
+            token = self.get_token()
+            if not token: return "❌ Auth Failed"
+            headers = {"X-Authorization": f"Bearer {token}"}
+
+            with ThreadPoolExecutor(max_workers=CLOUD_WORKERS) as pool:
+                # One depth level at a time, so a parent is only removed once all its children are gone
+                blocked = set()
+                for depth in sorted({n['depth'] for n in plan['nodes']}, reverse=True):
+                    level = []
+                    for n in plan['nodes']:
+                        if n['depth'] != depth:
+                            continue
+                        if n['id'] in blocked:
+                            blocked.update(n['parents'])
+                        elif n['status'] == 'draft':
+                            deleted.add(n['id'])
+                        else:
+                            level.append(n)
+
+                    results = pool.map(lambda n: self._cloud_delete(
+                        f"{TB_URL}/api/{'device' if 'Device' in n['labels'] else 'asset'}/{n['id']}", headers), level)
+                    for n, error in zip(level, results):
+                        if error:
+                            errors.append(f"'{n['name']}': {error}")
+                            blocked.update(n['parents'])
+                        else:
+                            deleted.add(n['id'])
+
+                # Only links that lost an endpoint go; ThingsBoard may already have dropped them with it
+                synced = [link for link in plan['relations'] if link['status'] == 'synced']
+                cloud_links = [link for link in synced if link['from_id'] in deleted or link['to_id'] in deleted]
+                results = pool.map(lambda link: self._cloud_delete(f"{TB_URL}/api/relation", headers, params={
+                    "fromId": link['from_id'], "fromType": "DEVICE" if "Device" in link['from_labels'] else "ASSET",
+                    "relationType": link['type'],
+                    "toId": link['to_id'], "toType": "DEVICE" if "Device" in link['to_labels'] else "ASSET"
+                }), cloud_links)
+                for link, error in zip(cloud_links, results):
+                    if error:
+                        errors.append(f"Link '{link['from_name']}' -> '{link['to_name']}': {error}")
+                    else:
+                        rel_count += 1
+        else:
+            deleted = {n['id'] for n in plan['nodes']}
+
+        with self.driver.session() as session:
+            shared = session.execute_write(self._detach_subtree_tx, deleted, plan)
+            ids = list(deleted)
+            for i in range(0, len(ids), DELETE_BATCH_SIZE):
+                session.run("UNWIND $ids AS id MATCH (n {id: id}) DETACH DELETE n", ids=ids[i:i + DELETE_BATCH_SIZE])
+        if shared:
+            refresh_rollups(self.driver)
+
+        total = len(plan['nodes'])
+        cloud = f" ({rel_count} Cloud Links removed)" if policy == "strict" else ""
+        if not errors:
+            return f"✅ Cascade deleted {len(deleted)} entities{cloud}."
+        kept = [n['name'] for n in plan['nodes'] if n['id'] not in deleted]
+        return (f"⚠️ Cascade deleted {len(deleted)}/{total} entities{cloud}. Kept: {', '.join(kept)}. "
+                f"Errors: " + " | ".join(errors))
 
     def delete_relation(self, from_name, to_name, rel_type, policy="safe"):
         msg = ""
@@ -373,8 +837,8 @@ class IoTManager:
                         msg += "⚠️ Cloud Fail. "
 
         with self.driver.session() as session:
-            query = f"MATCH (a {{name: $f}})-[r:{rel_type}]->(b {{name: $t}}) DELETE r"
-            session.run(query, f=from_name, t=to_name)
+            if session.execute_write(self._delete_relation_tx, from_name, to_name, rel_type):
+                refresh_rollups(self.driver)
             msg += "🗑️ Graph Link Deleted."
 
         return msg
@@ -413,9 +877,22 @@ def confirm_delete_dialog(item_type, item_id_or_name, extra_info=None, policy="s
     else:
         st.info("Safe Mode: Deletes from local Graph only.")
 
+    cascade = False
+    if item_type == "Asset":
+        cascade = st.checkbox("Cascade to everything it contains")
+        if cascade:
+            plan = manager.preview_cascade_delete(item_id_or_name)
+            devices = sum(1 for n in plan['nodes'] if "Device" in n['labels'])
+            st.caption(f"Dry run: {len(plan['nodes']) - devices} Assets, {devices} Devices and "
+                       f"{len(plan['relations'])} Relationships will be removed.")
+            with st.expander("Deletion order (leaves first)"):
+                st.write(", ".join(n['name'] for n in plan['nodes']))
+
     col1, col2 = st.columns(2)
     if col1.button("Yes, Delete", type="primary", use_container_width=True):
-        if item_type == "Asset":
+        if cascade:
+            msg = manager.cascade_delete(item_id_or_name, policy)
+        elif item_type == "Asset":
             msg = manager.delete_node(item_id_or_name, "Asset", policy)
         elif item_type == "Device":
             msg = manager.delete_node(item_id_or_name, "Device", policy)
@@ -436,6 +913,24 @@ if st.sidebar.button("⬇️ Import Cloud Data", help="Import Assets & Devices f
     with st.spinner("Importing..."):
         msg = manager.import_from_cloud()
         notify_and_rerun(msg)
+if st.sidebar.button("🔄 Rebuild Rollups", help="Recompute descendant counts for every Asset"):
+    with st.spinner("Rebuilding..."):
+        msg = manager.rebuild_rollups()
+        notify_and_rerun(msg)
+with st.sidebar.expander("📦 Snapshot"):
+    if st.button("Export Snapshot", help="Save the whole graph as compressed JSONL"):
+        buffer = io.BytesIO()
+        st.session_state.snapshot_msg = manager.export_snapshot(buffer)
+        st.session_state.snapshot = buffer.getvalue()
+    if 'snapshot' in st.session_state:
+        st.caption(st.session_state.snapshot_msg)
+        st.download_button("⬇️ Download", st.session_state.snapshot, file_name="graph-snapshot.jsonl.gz",
+                           mime="application/gzip")
+    uploaded = st.file_uploader("Warm Start", type=["gz"], help="Restore a snapshot, then delta sync with ThingsBoard")
+    if uploaded and st.button("♻️ Restore + Delta Sync"):
+        with st.spinner("Restoring..."):
+            msg = manager.warm_start(uploaded)
+            notify_and_rerun(msg)
 st.sidebar.markdown("---")
 st.sidebar.subheader("2. Synchronization")
 c1, c2 = st.sidebar.columns(2)
@@ -462,6 +957,10 @@ if view == "Infrastructure":
         for a in manager.get_assets():
             c1, c2, c3 = st.columns([3, 2, 1])
             c1.write(f"**{a['Name']}** ({a['Type']})")
+            if a['Devices'] is not None:
+                types = ", ".join(f"{t}: {n}" for t, n in json.loads(a['DeviceTypes'] or "{}").items())
+                c1.caption(f"📟 {a['Devices']} devices ({a['DraftDevices']} draft){' · ' + types if types else ''}"
+                           f" · 📝 {a['Drafts']} drafts · 🔗 {a['UnsyncedLinks']} unsynced links")
             c2.caption(a['Status'] or 'synced')
             if c3.button("❌", key=f"del_a_{a['ID']}"):
                 confirm_delete_dialog("Asset", a['ID'], policy=policy_code)
@@ -0,0 +1,93 @@
+import json
+
+ROLLUP_COUNTERS = ("assets", "devices", "devices_synced", "devices_draft", "drafts", "unsynced_links")
+ROLLUP_BATCH_SIZE = 1000
+UNSYNCED_LINKS = "(m:Asset OR m:Device) AND coalesce(rel.status, '') <> 'synced'"
+
+
+def empty_rollup():
+    rollup = {key: 0 for key in ROLLUP_COUNTERS}
+    rollup["device_types"] = {}
+    return rollup
+
+
+def add_rollup(total, delta, sign=1):
+    """Add (or subtract, with sign=-1) the counters of delta into total"""
+    for key in ROLLUP_COUNTERS:
+        total[key] += sign * delta.get(key, 0)
+    for dev_type, count in delta.get("device_types", {}).items():
+        new_count = total["device_types"].get(dev_type, 0) + sign * count
+        if new_count:
+            total["device_types"][dev_type] = new_count
+        else:
+            total["device_types"].pop(dev_type, None)
+    return total
+
+
+def node_rollup(labels, node_type, status):
+    """Counters a single node contributes to the rollups of the Assets above it"""
+    rollup = empty_rollup()
+    is_draft = status == 'draft'
+    if "Device" in labels:
+        rollup["devices"] = 1
+        rollup["devices_draft" if is_draft else "devices_synced"] = 1
+        rollup["device_types"] = {node_type or "default": 1}
+    else:
+        rollup["assets"] = 1
+    rollup["drafts"] = 1 if is_draft else 0
+    return rollup
+
+
+def rollup_to_props(rollup):
+    props = {f"rollup_{key}": rollup[key] for key in ROLLUP_COUNTERS}
+    props["rollup_device_types"] = json.dumps(rollup["device_types"], sort_keys=True)
+    return props
+
+
+def rollup_from_props(props):
+    rollup = empty_rollup()
+    for key in ROLLUP_COUNTERS:
+        rollup[key] = props.get(f"rollup_{key}") or 0
+    rollup["device_types"] = json.loads(props.get("rollup_device_types") or "{}")
+    return rollup
+
+
+def refresh_rollups(driver):
+    """
+    Recompute the rollups of every Asset from scratch and return how many were written.
+    Each Asset counts its distinct Contains descendants once, so cycles and shared children are safe.
+    """
+    with driver.session() as session:
+        nodes = {r['id']: r.data() for r in session.run(f"""
+            MATCH (n) WHERE n:Asset OR n:Device
+            OPTIONAL MATCH (n)-[rel]->(m) WHERE {UNSYNCED_LINKS}
+            RETURN n.id AS id, labels(n) AS labels, n.type AS type, n.status AS status, count(rel) AS unsynced
+        """)}
+        children = {}
+        for r in session.run("MATCH (p)-[:Contains]->(c) WHERE (p:Asset OR p:Device) AND (c:Asset OR c:Device) "
+                             "RETURN p.id AS parent, c.id AS child"):
+            children.setdefault(r['parent'], []).append(r['child'])
+
+        rows = []
+        for node_id, n in nodes.items():
+            if "Asset" not in n['labels']:
+                continue
+            rollup = empty_rollup()
+            rollup["unsynced_links"] = n['unsynced']
+            seen = {node_id}
+            stack = list(children.get(node_id, []))
+            while stack:
+                child_id = stack.pop()
+                if child_id in seen:
+                    continue
+                seen.add(child_id)
+                child = nodes[child_id]
+                add_rollup(rollup, node_rollup(child['labels'], child['type'], child['status']))
+                rollup["unsynced_links"] += child['unsynced']
+                stack.extend(children.get(child_id, []))
+            rows.append({"id": node_id, "props": rollup_to_props(rollup)})
+
+        for i in range(0, len(rows), ROLLUP_BATCH_SIZE):
+            session.run("UNWIND $rows AS row MATCH (a:Asset {id: row.id}) SET a += row.props",
+                        rows=rows[i:i + ROLLUP_BATCH_SIZE])
+    return len(rows)
@@ -0,0 +1,118 @@
+from collections import deque
+
+import requests
+
+
+ENTITY_TYPES = ("ASSET", "DEVICE")
+
+
+def query_relations(tb_url, headers, root_id, root_type, direction, max_level=0, relation_types=None):
+    """
+    Every relation reachable from a root in one call, using ThingsBoard's relation query API.
+    max_level <= 0 lets ThingsBoard walk the whole hierarchy. Returns None if the query failed.
+    """
+    query = {
+        "parameters": {
+            "rootId": root_id, "rootType": root_type, "direction": direction,
+            "relationTypeGroup": "COMMON", "maxLevel": max_level, "fetchLastLevelOnly": False
+        },
+        "filters": [{"relationType": t, "entityTypes": list(ENTITY_TYPES)} for t in relation_types or []]
+    }
+    try:
+        res = requests.post(f"{tb_url}/api/relations/info", json=query, headers=headers)
+        if res.status_code == 200:
+            return res.json()
+    except:
+        pass
+    return None
+
+
+def get_entity_relations(tb_url, headers, entity_id, entity_type):
+    """Outgoing relations of a single entity, or None if they could not be read"""
+    try:
+        res = requests.get(f"{tb_url}/api/relations/info?fromId={entity_id}&fromType={entity_type}", headers=headers)
+        if res.status_code == 200:
+            return res.json()
+    except:
+        pass
+    return None
+
+
+def covered_entities(root_id, tree, max_level):
+    """
+    Entities of a traversal whose outgoing relations were all returned.
+    ThingsBoard expands each entity from whichever path claims it first, so with a level limit an
+    entity only counts when every path to it in the tree is shorter than the limit.
+    """
+    if max_level <= 0:
+        return {root_id} | {r['from']['id'] for r in tree} | {r['to']['id'] for r in tree}
+
+    children = {}
+    indegree = {root_id: 0}
+    for r in tree:
+        if r['to']['id'] == root_id:
+            continue
+        children.setdefault(r['from']['id'], []).append(r['to']['id'])
+        indegree[r['to']['id']] = indegree.get(r['to']['id'], 0) + 1
+
+    # Longest path in topological order; entities on a cycle are never released and stay uncovered
+    longest = {root_id: 0}
+    covered = set()
+    queue = deque([root_id])
+    while queue:
+        node = queue.popleft()
+        if longest[node] < max_level:
+            covered.add(node)
+        for child in children.get(node, []):
+            longest[child] = max(longest.get(child, 0), longest[node] + 1)
+            indegree[child] -= 1
+            if indegree[child] == 0:
+                queue.append(child)
+    return covered
+
+
+def extract_relations(tb_url, headers, entity_refs, known_children=(), max_level=0, relation_types=None,
+                      failed=None):
+    """
+    Outgoing Asset/Device relations of (id, ENTITY_TYPE) pairs, fetched hierarchy by hierarchy.
+    Each asset no earlier traversal has covered is traversed downwards in one call. Assets already
+    known to have a parent (known_children, usually read from the graph) are tried last, so most of
+    them are covered by their root's traversal by then.
+    Only entities that no traversal fully expanded fall back to one call each.
+    IDs whose relations could not be read at all are added to the failed set, if one is given.
+    """
+    expanded = set()
+    relations = {}
+
+    def keep(r):
+        if r['from']['entityType'] in ENTITY_TYPES and r['to']['entityType'] in ENTITY_TYPES:
+            relations[(r['from']['id'], r['to']['id'], r['type'])] = r
+
+    roots = sorted((ref for ref in entity_refs if ref[1] == 'ASSET'), key=lambda ref: ref[0] in known_children)
+    for root_id, root_type in roots:
+        if root_id in expanded:
+            continue
+        tree = query_relations(tb_url, headers, root_id, root_type, "FROM", max_level, relation_types)
+        if tree is None:
+            continue
+        for r in tree:
+            keep(r)
+        if relation_types and max_level > 0:
+            # Filtered-out links may have claimed entities on a longer path, so only the root is certain
+            expanded.add(root_id)
+        else:
+            expanded.update(covered_entities(root_id, tree, max_level))
+
+    for entity_id, entity_type in entity_refs:
+        if entity_id in expanded:
+            continue
+        entity_relations = get_entity_relations(tb_url, headers, entity_id, entity_type)
+        if entity_relations is None:
+            if failed is not None:
+                failed.add(entity_id)
+            continue
+        for r in entity_relations:
+            if not relation_types or r['type'] in relation_types:
+                keep(r)
+
+    return list(relations.values())
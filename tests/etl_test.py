@@ -1,8 +1,16 @@
 import requests
 from neo4j import GraphDatabase
 import os
+import sys
+import zlib
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
 
+# Shared graph helpers live next to app.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rollups import refresh_rollups
+from tb_relations import extract_relations
+
 load_dotenv()
 TB_URL = os.getenv("TB_URL")
 TB_USER = os.getenv("TB_USER")
@@ -10,16 +18,21 @@ TB_PASS = os.getenv("TB_PASSWORD")
 NEO_URI = os.getenv("NEO4J_URI")
 NEO4J_USER = os.getenv("NEO4J_USER")
 NEO4J_PASS = os.getenv("NEO4J_PASSWORD")
+ETL_TENANTS = os.getenv("ETL_TENANTS", "")
+ETL_PARTITIONS = int(os.getenv("ETL_PARTITIONS", "1"))
+ETL_WORKERS = int(os.getenv("ETL_WORKERS", "0")) or None
+ENTITY_GROUPS = [("asset", "Asset"), ("device", "Device")]
+RELATION_MAX_LEVEL = int(os.getenv("RELATION_MAX_LEVEL", "0"))
 if not TB_URL:
     raise ValueError("TB_URL is not set. Please check your .env file.")
 
 print(f"Connecting to ThingsBoard at: {TB_URL}")
 
 
-def get_tb_token():
+def get_tb_token(username=TB_USER, password=TB_PASS):
     url = f"{TB_URL}/api/auth/login"
     try:
-        res = requests.post(url, json={"username": TB_USER, "password": TB_PASS})
+        res = requests.post(url, json={"username": username, "password": password})
         res.raise_for_status()
         return res.json()['token']
     except Exception as e:
@@ -29,10 +42,18 @@ def get_tb_token():
 
 def get_tb_entities(token, entity_type):
     """Fetch all Assets or Devices"""
-    url = f"{TB_URL}/api/tenant/{entity_type}s?pageSize=1000&page=0"
     headers = {"X-Authorization": f"Bearer {token}"}
-    res = requests.get(url, headers=headers)
-    return res.json()['data']
+    items = []
+    page = 0
+    while True:
+        url = f"{TB_URL}/api/tenant/{entity_type}s?pageSize=1000&page={page}"
+        res = requests.get(url, headers=headers)
+        res.raise_for_status()
+        body = res.json()
+        items.extend(body['data'])
+        if not body.get('hasNext'):
+            return items
+        page += 1
 
 
 def get_tb_attributes(token, entity_id, entity_type):
@@ -50,12 +71,6 @@ def get_tb_attributes(token, entity_id, entity_type):
     return {}
 
 
-def get_tb_relations(token, entity_id, entity_type):
-    url = f"{TB_URL}/api/relations?fromId={entity_id}&fromType={entity_type}"
-    headers = {"X-Authorization": f"Bearer {token}"}
-    res = requests.get(url, headers=headers)
-    return res.json() if res.status_code == 200 else []
-
 class GraphDB:
     def __init__(self):
         self.driver = GraphDatabase.driver(NEO_URI, auth=(NEO4J_USER, NEO4J_PASS))
@@ -69,6 +84,13 @@ class GraphDB:
             result = session.run(f"MATCH (n:{label}) RETURN n.id as id")
             return {record["id"] for record in result}
 
+    def get_child_ids(self):
+        """IDs that already have a parent in the graph, so traversals start from their roots first"""
+        with self.driver.session() as session:
+            result = session.run("MATCH (a)-->(n) WHERE (a:Asset OR a:Device) AND (n:Asset OR n:Device) "
+                                 "RETURN DISTINCT n.id AS id")
+            return {record["id"] for record in result}
+
     def delete_node(self, entity_id):
         """Remove a node that no longer exists in ThingsBoard"""
         with self.driver.session() as session:
@@ -110,12 +132,10 @@ def run_etl():
 
     db = GraphDB()
 
-    entity_groups = [("asset", "Asset"), ("device", "Device")]
-
     all_current_tb_ids = set()
     all_entities_data = []
 
-    for tb_type, graph_label in entity_groups:
+    for tb_type, graph_label in ENTITY_GROUPS:
         print(f"📥 Processing {graph_label}s...")
 
         tb_items = get_tb_entities(token, tb_type)
@@ -138,19 +158,164 @@ def run_etl():
             db.delete_node(del_id)
 
     print("🔗 Syncing Relations...")
-    for entity in all_entities_data:
-        e_id = entity['id']['id']
-        e_type = entity['id']['entityType']
-
-        relations = get_tb_relations(token, e_id, e_type)
-        for r in relations:
-            to_id = r['to']['id']
-            rel_type = r['type']
-            db.create_relation(e_id, to_id, rel_type)
+    entity_refs = [(e['id']['id'], e['id']['entityType']) for e in all_entities_data]
+    headers = {"X-Authorization": f"Bearer {token}"}
+    for r in extract_relations(TB_URL, headers, entity_refs, db.get_child_ids(), max_level=RELATION_MAX_LEVEL):
+        db.create_relation(r['from']['id'], r['to']['id'], r['type'])
 
+    print(f"📊 Rollups rebuilt for {refresh_rollups(db.driver)} Assets")
     print("✅ Smart Sync Complete!")
     db.close()
 
 
+def load_tenants():
+    """Tenant accounts to crawl: ETL_TENANTS="user:pass,user2:pass2", or the TB_USER account"""
+    tenants = []
+    for entry in ETL_TENANTS.split(","):
+        if entry.strip():
+            username, _, password = entry.strip().partition(":")
+            tenants.append((username, password))
+    return tenants or [(TB_USER, TB_PASS)]
+
+
+def shard_of(entity_id, partitions):
+    """Stable partition of an entity ID, the same in every process"""
+    return zlib.crc32(entity_id.encode()) % partitions
+
+
+def etl_node_shard(username, password, items):
+    """Worker: upsert one shard of entities with its own ThingsBoard session and Neo4j driver"""
+    token = get_tb_token(username, password)
+    if not token:
+        raise RuntimeError(f"TB Login Failed for {username}")
+
+    db = GraphDB()
+    seen = {label: set() for _, label in ENTITY_GROUPS}
+    try:
+        for tb_type, graph_label, item in items:
+            e_id = item['id']['id']
+            attrs = get_tb_attributes(token, e_id, tb_type)
+            db.upsert_node(item, attrs, graph_label)
+            seen[graph_label].add(e_id)
+    finally:
+        db.close()
+    return seen
+
+
+def etl_relation_extract(username, password, entity_refs, known_children, partitions):
+    """Worker: traverse one tenant's relations with its own ThingsBoard session, bucketed by write shard"""
+    token = get_tb_token(username, password)
+    if not token:
+        raise RuntimeError(f"TB Login Failed for {username}")
+
+    headers = {"X-Authorization": f"Bearer {token}"}
+    failed = set()
+    buckets = [[] for _ in range(partitions)]
+    for r in extract_relations(TB_URL, headers, entity_refs, known_children, max_level=RELATION_MAX_LEVEL,
+                               failed=failed):
+        buckets[shard_of(r['from']['id'], partitions)].append((r['from']['id'], r['to']['id'], r['type']))
+    if failed:
+        raise RuntimeError(f"Relations of {len(failed)} entities could not be read for {username}")
+    return buckets
+
+
+def etl_relation_shard(relations):
+    """Worker: write one shard of already extracted relations, once every shard's nodes exist"""
+    db = GraphDB()
+    try:
+        for from_id, to_id, rel_type in relations:
+            db.create_relation(from_id, to_id, rel_type)
+    finally:
+        db.close()
+    return len(relations)
+
+
+def run_sharded_etl(partitions=ETL_PARTITIONS, workers=ETL_WORKERS):
+    """
+    Coordinator: split every tenant's entities into ID-hash partitions and run them on a process pool.
+    Relations are extracted by one job per tenant and only their writes are sharded, so no hierarchy is
+    traversed twice. Deletions are only reconciled once all shards of all tenants have finished cleanly.
+    """
+    print(f"🚀 Starting Sharded ETL ({partitions} partitions per tenant)...")
+    complete = True
+    shards = []
+    tenant_refs = []
+
+    for username, password in load_tenants():
+        token = get_tb_token(username, password)
+        if not token:
+            complete = False
+            continue
+
+        buckets = [[] for _ in range(partitions)]
+        try:
+            for tb_type, graph_label in ENTITY_GROUPS:
+                for item in get_tb_entities(token, tb_type):
+                    buckets[shard_of(item['id']['id'], partitions)].append((tb_type, graph_label, item))
+        except Exception as e:
+            print(f"❌ Listing failed for {username}: {e}")
+            complete = False
+            continue
+
+        shards.extend((username, password, bucket) for bucket in buckets if bucket)
+        entity_refs = [(item['id']['id'], item['id']['entityType']) for b in buckets for _, _, item in b]
+        tenant_refs.append((username, password, entity_refs))
+        print(f"📥 {username}: {len(entity_refs)} entities")
+
+    seen = {label: set() for _, label in ENTITY_GROUPS}
+    rel_count = 0
+    db = GraphDB()
+    known_children = db.get_child_ids()
+    db.close()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        node_jobs = [pool.submit(etl_node_shard, *shard) for shard in shards]
+        extract_jobs = [pool.submit(etl_relation_extract, *tenant, known_children, partitions)
+                        for tenant in tenant_refs]
+
+        # Each relation lands in exactly one write shard, whichever tenant it came from
+        rel_buckets = [[] for _ in range(partitions)]
+        for job in extract_jobs:
+            try:
+                for bucket, relations in zip(rel_buckets, job.result()):
+                    bucket.extend(relations)
+            except Exception as e:
+                print(f"❌ Relation extraction failed: {e}")
+                complete = False
+
+        # Relations may point across shards, so every node has to be written before any relation
+        for job in node_jobs:
+            try:
+                for label, ids in job.result().items():
+                    seen[label] |= ids
+            except Exception as e:
+                print(f"❌ Node shard failed: {e}")
+                complete = False
+
+        rel_jobs = [pool.submit(etl_relation_shard, bucket) for bucket in rel_buckets if bucket]
+        for job in rel_jobs:
+            try:
+                rel_count += job.result()
+            except Exception as e:
+                print(f"❌ Relation shard failed: {e}")
+                complete = False
+
+    print(f"🔗 Synced {rel_count} Relations")
+
+    db = GraphDB()
+    if complete:
+        for _, graph_label in ENTITY_GROUPS:
+            for del_id in db.get_all_node_ids(graph_label) - seen[graph_label]:
+                db.delete_node(del_id)
+    else:
+        print("⚠️ Some shards failed, skipping deletions to avoid removing live entities.")
+
+    print(f"📊 Rollups rebuilt for {refresh_rollups(db.driver)} Assets")
+    db.close()
+    print("✅ Sharded Sync Complete!" if complete else "⚠️ Sharded Sync Incomplete.")
+
+
 if __name__ == "__main__":
-    run_etl()
\ No newline at end of file
+    if ETL_TENANTS or ETL_PARTITIONS > 1:
+        run_sharded_etl()
+    else:
+        run_etl()
\ No newline at end of file